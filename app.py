@@ -1,10 +1,18 @@
+import hashlib
+import importlib.util
+import io
+import json
 import os
+import queue
 import re
+import threading
 import time
-import openai
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 import streamlit as st
-from typing_extensions import override
-from openai import AssistantEventHandler
+
+_FILE_ID_RE = re.compile(r"\bfile-[a-zA-Z0-9]+")
 
 # -----------------------------------------------------------------------------
 # ⚙️  CONFIGURATION
@@ -23,6 +31,24 @@ DEFAULT_PROMPT = (
 ASSISTANT_NAME = "THREATLENS-AI-Agent"
 MODEL_NAME = "gpt-4.1"
 TEMP = 0.2
+# Where a freshly created assistant's id is remembered so later server processes
+# reuse it instead of creating a new one.  ASSISTANT_ID in secrets/env wins.
+ASSISTANT_ID_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".assistant_id")
+# Zip members that only cost upload time and Code Interpreter tokens
+SKIP_DIRS = {".git", "node_modules", "__pycache__", "__MACOSX", ".venv", "venv", ".mypy_cache", ".pytest_cache"}
+SKIP_EXTS = {
+    ".png", ".jpg", ".jpeg", ".gif", ".bmp", ".ico", ".svg", ".webp",
+    ".mp3", ".mp4", ".mov", ".wav",
+    ".woff", ".woff2", ".ttf", ".eot",
+    ".pyc", ".so", ".dll", ".exe",
+    ".h5", ".pkl", ".pt", ".pth", ".onnx", ".npy",
+}
+# Uploads are untrusted: past these uncompressed sizes the zip is sent as-is
+# instead of being expanded in memory (zip bombs)
+MAX_MEMBER_BYTES = 64 * 1024 * 1024
+MAX_UNZIPPED_BYTES = 512 * 1024 * 1024
+STREAM_FLUSH_INTERVAL = 0.3  # seconds between live-output refreshes while a run streams
+LIVE_PAGE_CHARS = 8000  # finalized text kept in the live fragment before it is handed off
 
 # -----------------------------------------------------------------------------
 # 🖼️  STREAMLIT UI CONFIG
@@ -30,36 +56,29 @@ TEMP = 0.2
 st.set_page_config(page_title="ThreatLens‑AI", page_icon="🛡️", layout="wide")
 st.title("🛡️ ThreatLens‑AI Repository Analyzer")
 
-# Hide the Streamlit default menu/footer for a cleaner look
-st.markdown(
-    """
-    <style>
-        #MainMenu {visibility: hidden;}
-        footer {visibility: hidden;}
-        .block-container {padding-top: 2rem;}
-    </style>
-    """,
-    unsafe_allow_html=True,
-)
+# Hide the Streamlit default menu/footer for a cleaner look.  Emitted on every
+# run on purpose: Streamlit drops elements a rerun doesn't re-emit, and an
+# unchanged element is not re-sent to the browser as a new <style> tag.
+_CSS = "<style>#MainMenu{visibility:hidden}footer{visibility:hidden}.block-container{padding-top:2rem}</style>"
+st.markdown(_CSS, unsafe_allow_html=True)
 
 # -----------------------------------------------------------------------------
 # 🔑  INITIALISE OPENAI CLIENT & ASSISTANT
 # -----------------------------------------------------------------------------
-if API_KEY:
-    client = openai.OpenAI(api_key=API_KEY)
-else:
-    client = openai.OpenAI()
-
-# Cache assistant creation so we do it only once per session --------------------------------
+# One client (and connection pool) per process. Over HTTP/2 the concurrent
+# uploads, lookups and deletes share a single multiplexed connection; HTTP/2
+# needs the optional ``h2`` package and is skipped without it.  The SDK's own
+# timeout and pool limits are kept, so no direct httpx import is needed.
+# openai (with pydantic, httpx, …) is imported on first use rather than at the
+# top, so the page renders before the SDK has been loaded.
 @st.cache_resource(show_spinner=False)
-def _get_or_create_assistant():
-    # NOTE: in production you might store a static assistant_id in env/secrets
-    assistant = client.beta.assistants.create(
-        name=ASSISTANT_NAME,
-        model=MODEL_NAME,
-        temperature=TEMP,
-        tools=[{"type": "code_interpreter"}],
-        instructions="""
+def _get_client():
+    import openai
+
+    http_client = openai.DefaultHttpxClient(http2=importlib.util.find_spec("h2") is not None)
+    return openai.OpenAI(api_key=API_KEY or None, http_client=http_client)
+
+ASSISTANT_INSTRUCTIONS = """
 You are **THREATLENS-AI-Agent**, 
 an expert Generative-AI assistant that automates threat-modeling and security assessment for healthcare software projects.
 and write and a detailed generate a Medical-Diagnosis-Project-Report.md file.
@@ -82,159 +101,620 @@ and write and a detailed generate a Medical-Diagnosis-Project-Report.md file.
 4. **Healthcare context:** Call out HIPAA Privacy/Security Rule impacts and PHI exposure points.  
 5. **Assumptions & gaps:** If information is missing, state assumptions explicitly and proceed.  
 6. **Tone:** Professional, concise, actionable—avoid jargon the reader can’t act on.  
-7. **Compliance reminders:** Recommend early remediation in the SDLC and reference OWASP SAMM / NIST SSDF where relevant.""",
+7. **Compliance reminders:** Recommend early remediation in the SDLC and reference OWASP SAMM / NIST SSDF where relevant."""
+
+
+def _configured_assistant_ids() -> list[str]:
+    """Candidate assistant ids, most authoritative first: secrets/env, then file."""
+    try:
+        aid = st.secrets.get("ASSISTANT_ID")
+    except Exception:  # no secrets.toml
+        aid = None
+    ids = [aid or os.environ.get("ASSISTANT_ID")]
+    if os.path.exists(ASSISTANT_ID_FILE):
+        with open(ASSISTANT_ID_FILE) as f:
+            ids.append(f.read().strip())
+    return [aid for aid in ids if aid]
+
+
+# Cache the assistant so we fetch it only once per process; across restarts the
+# persisted id is retrieved and a new assistant is only created when that fails
+@st.cache_resource(show_spinner=False)
+def _get_or_create_assistant():
+    import openai
+
+    client = _get_client()
+    settings = dict(model=MODEL_NAME, temperature=TEMP, instructions=ASSISTANT_INSTRUCTIONS)
+    for aid in _configured_assistant_ids():
+        try:
+            assistant = client.beta.assistants.retrieve(aid)
+        except openai.NotFoundError:
+            print(f"Assistant {aid} not found; ignoring stale id")
+            continue
+        # Keep a reused assistant in line with the configuration above
+        if any(getattr(assistant, k) != v for k, v in settings.items()):
+            assistant = client.beta.assistants.update(aid, **settings)
+        return assistant
+    assistant = client.beta.assistants.create(
+        name=ASSISTANT_NAME,
+        tools=[{"type": "code_interpreter"}],
+        **settings,
     )
+    try:
+        with open(ASSISTANT_ID_FILE, "w") as f:
+            f.write(assistant.id)
+    except OSError as e:
+        print("Could not persist assistant id:", e)
     return assistant
 
-assistant = _get_or_create_assistant()
+def _notebook_to_markdown(raw: bytes) -> str:
+    nb = json.loads(raw)
+    if not isinstance(nb, dict):
+        raise ValueError("not a notebook")
+    lang = nb.get("metadata", {}).get("language_info", {}).get("name", "")
+    parts = []
+    for cell in nb.get("cells", []):
+        src = cell.get("source", "")
+        if not isinstance(src, (str, list)):
+            raise TypeError(f"unexpected cell source: {type(src).__name__}")
+        src = "".join(src)
+        # Outputs (often base64 images) are dropped; only the cell sources matter
+        parts.append(f"```{lang}\n{src}\n```" if cell.get("cell_type") == "code" else src)
+    return "\n\n".join(parts) + "\n"
+
+
+def _slim_zip(data: bytes) -> bytes:
+    """Repack the uploaded repository without vendored or binary members.
+
+    Notebooks are converted to Markdown (``x.ipynb`` → ``x.ipynb.md``); source,
+    templates and configs are kept byte for byte since they are what the
+    assistant analyses.  Everything is recompressed with DEFLATE level 9, as
+    uploads are often stored uncompressed.  The original bytes are returned if
+    they can't be read or the repack doesn't come out smaller.
+    """
+    out = io.BytesIO()
+    try:
+        _repack_zip(data, out)
+    except Exception as e:  # sending the original is always safe
+        print("Sending zip as uploaded:", e)
+        return data
+    slim = out.getvalue()
+    return slim if len(slim) < len(data) else data
+
+
+def _repack_zip(data: bytes, out: io.BytesIO):
+    with zipfile.ZipFile(io.BytesIO(data)) as zin, zipfile.ZipFile(
+        out, "w", zipfile.ZIP_DEFLATED, compresslevel=9
+    ) as zout:
+        infos = zin.infolist()
+        if sum(info.file_size for info in infos) > MAX_UNZIPPED_BYTES or any(
+            info.file_size > MAX_MEMBER_BYTES for info in infos
+        ):
+            raise ValueError("zip expands past the repack size limits")
+        for info in infos:
+            if info.is_dir():
+                continue
+            *dirs, name = info.filename.split("/")
+            ext = os.path.splitext(name)[1].lower()
+            if SKIP_DIRS.intersection(dirs) or ext in SKIP_EXTS or name == ".DS_Store":
+                continue
+            filename, content = info.filename, zin.read(info)
+            if ext == ".ipynb":
+                try:
+                    filename, content = filename + ".md", _notebook_to_markdown(content).encode("utf-8")
+                except (ValueError, TypeError, AttributeError):
+                    pass  # not a well-formed notebook; ship it untouched
+            zout.writestr(filename, content)
+
+
+# Streamlit reruns the whole script on every interaction; key uploads on the zip
+# content so the same bytes are only slimmed and sent to OpenAI once (``_data``
+# is excluded from the cache key by its leading underscore).  The cache is
+# process-wide, so ``session_key`` keeps one session's Reset from deleting a
+# file another session still uses; the ttl expires ids of files deleted elsewhere.
+@st.cache_data(show_spinner=False, ttl="1h")
+def _upload_zip(session_key: str, sha: str, name: str, _data: bytes) -> str:
+    return _get_client().files.create(file=(name, _slim_zip(_data)), purpose="assistants").id
 
 # -----------------------------------------------------------------------------
 # 🗄️  SESSION STATE
 # -----------------------------------------------------------------------------
-for key in (
-    "thread_id",
-    "file_id",
-    "run_finished",
-    "report_bytes",
-    "report_name",
-):
-    if key not in st.session_state:
-        st.session_state[key] = None
+_DEFAULTS = {
+    "thread_id": None,
+    "file_id": None,
+    "run_finished": False,
+    "report_buf": None,
+    "report_name": None,
+    "zip_sha": None,
+    "md_file_id": None,
+    "run_queue": None,
+    "run_abort": None,
+    "run_view": None,
+    "run_error": None,
+    "stale_file_ids": (),
+}
+for key, value in _DEFAULTS.items():
+    st.session_state.setdefault(key, value)
+if "upload_key" not in st.session_state:
+    st.session_state.upload_key = uuid.uuid4().hex
 
 # -----------------------------------------------------------------------------
 # 📤  FILE UPLOAD SECTION
 # -----------------------------------------------------------------------------
-zip_file = st.file_uploader("Upload a zipped project repository", type=["zip"], help=".zip only")
+# Inside a form, editing the inputs doesn't rerun the script; only submitting does
+with st.form("analyse", clear_on_submit=False):
+    zip_file = st.file_uploader("Upload a zipped project repository", type=["zip"], help=".zip only")
+
+    # Prompt box (pre‑filled but editable so you can tweak if needed)
+    user_prompt = st.text_area("Repository analysis prompt", value=DEFAULT_PROMPT, height=120)
+
+    # Batch mode polls for the finished report instead of streaming every token
+    live = st.checkbox("Live stream tokens", value=True)
+
+    # Form widgets only report their value on submit, so a missing zip is
+    # checked afterwards instead of disabling the button
+    run_btn = st.form_submit_button(
+        "▶️  Analyse Repository",
+        type="primary",
+        disabled=st.session_state.run_queue is not None,
+    )
+
+if run_btn and zip_file is None:
+    st.warning("Please upload a zipped repository first.")
+
+# -----------------------------------------------------------------------------
+# ✍️  STREAMING HELPERS
+# -----------------------------------------------------------------------------
+class _SelectiveBuffer:
+    """Withhold characters that may open a markdown construct until it resolves.
+
+    Feeding half-formed syntax (a lone ``*``, ``[text](`` or an opening fence) to
+    ``st.markdown`` makes the raw characters flicker on screen.  ``feed`` only
+    returns text whose rendering can no longer change; anything that turns out
+    not to be markup is released verbatim.
+    """
+
+    TEXT, MAYBE_EMPH, LINK_TEXT, LINK_URL, FENCE_OPEN = range(5)
+    MAX_HOLD = 256  # never stall the stream on an unterminated construct
+
+    def __init__(self):
+        self.state = self.TEXT
+        self.held = ""
+        self.delim = ""
+        self.prev = "\n"
+        self.in_fence = False
+
+    def feed(self, text: str) -> str:
+        out = []
+        for ch in text:
+            out.append(self._step(ch))
+            self.prev = ch
+        return "".join(out)
+
+    def flush(self) -> str:
+        return self._release()
+
+    def _release(self, ch: str = "") -> str:
+        held, self.held, self.state = self.held + ch, "", self.TEXT
+        return held
 
-# Prompt box (pre‑filled but editable so you can tweak if needed)
-user_prompt = st.text_area("Repository analysis prompt", value=DEFAULT_PROMPT, height=120)
+    def _step(self, ch: str) -> str:
+        if self.state == self.TEXT:
+            if ch == "`" and self.prev == "\n":
+                self.state = self.FENCE_OPEN
+            elif self.in_fence:
+                return ch
+            elif ch == "*" or (ch == "_" and not self.prev.isalnum()):
+                self.state, self.delim = self.MAYBE_EMPH, ch
+            elif ch == "[":
+                self.state = self.LINK_TEXT
+            else:
+                return ch
+            self.held = ch
+            return ""
 
-run_btn = st.button("▶️  Analyse Repository", type="primary", disabled=(zip_file is None))
+        if self.state == self.FENCE_OPEN:
+            self.held += ch
+            if ch == "\n":
+                if self.held.startswith("```"):
+                    self.in_fence = not self.in_fence
+                return self._release()
+            if ch != "`" and not self.held.startswith("```"):
+                return self._release()  # inline code span, not a fence
+            return ""
+
+        # Emphasis and links never span lines here; give up and emit literally
+        if ch == "\n" or len(self.held) >= self.MAX_HOLD:
+            return self._release(ch)
+
+        if self.state == self.LINK_TEXT and self.held.endswith("]"):
+            if ch != "(":
+                return self._release(ch)  # plain "[x]", not a link
+            self.state = self.LINK_URL
+        self.held += ch
+        if self.state == self.LINK_URL:
+            return self._release() if ch == ")" else ""
+        if self.state == self.LINK_TEXT:
+            return ""
+
+        body = self.held.lstrip(self.delim)
+        if not body:
+            return ""  # still inside the opening run, e.g. "**"
+        if body == ch and ch.isspace():
+            return self._release()  # "* item" or "a * b": not emphasis
+        opener = len(self.held) - len(body)
+        if len(body) > opener and self.held.endswith(self.delim * opener):
+            return self._release()
+        return ""
+
+
+class _StreamView:
+    """Streamed text split into finalized markdown blocks plus a growing tail.
+
+    Completed top-level blocks (paragraphs, closed code fences) never change
+    once emitted, so each gets its own ``st.markdown`` element.  A fragment
+    rerun has to re-send every element it draws, so the live fragment only
+    holds the tail and the last page of blocks; once that page passes
+    ``LIVE_PAGE_CHARS`` it is sealed and drawn by the main script, which only
+    reruns at those hand-offs.  Per-tick work is thus bounded by the page size.
+    """
+
+    def __init__(self):
+        self.blocks = []
+        self.sealed = 0  # blocks[:sealed] are drawn outside the live fragment
+        self.tail_text = ""
+        self.in_fence = False
+        self._selective = _SelectiveBuffer()
+        self._scan = 0  # index in tail_text of the first line not yet inspected
+
+    def feed(self, text: str):
+        self.tail_text += self._selective.feed(text)
+        self._finalize_blocks()
+
+    def close(self):
+        self.tail_text += self._selective.flush()
+        self._finalize_blocks()
+
+    def render(self):
+        self.render_sealed()
+        self.render_live()
+
+    def render_sealed(self):
+        for block in self.blocks[:self.sealed]:
+            st.markdown(block)
+
+    def render_live(self):
+        for block in self.blocks[self.sealed:]:
+            st.markdown(block)
+        st.markdown(self.tail_text)
+
+    def seal(self) -> bool:
+        """Seal the live blocks once they fill a page; True if that happened."""
+        if sum(len(b) for b in self.blocks[self.sealed:]) < LIVE_PAGE_CHARS:
+            return False
+        self.sealed = len(self.blocks)
+        return True
+
+    def _finalize_blocks(self):
+        while True:
+            nl = self.tail_text.find("\n", self._scan)
+            if nl == -1:
+                return
+            line = self.tail_text[self._scan:nl]
+            self._scan = nl + 1
+            if line.lstrip().startswith("```"):
+                self.in_fence = not self.in_fence
+                if self.in_fence:
+                    continue
+            elif self.in_fence or line.strip() or not self.tail_text[:nl].strip():
+                continue
+            self.blocks.append(self.tail_text[:self._scan])
+            self.tail_text = self.tail_text[self._scan:]
+            self._scan = 0
+
+
+def _token_gen(client, thread_id: str, assistant_id: str, abort: threading.Event):
+    """Yield the assistant's text deltas as the run streams in.
+
+    Once ``abort`` is set the stream is closed and the run cancelled on
+    OpenAI's side; a run that ends any other way than completed raises.
+    """
+    with client.beta.threads.runs.stream(
+        thread_id=thread_id,
+        assistant_id=assistant_id,
+        tool_choice={"type": "code_interpreter"},
+    ) as stream:
+        for event in stream:
+            if abort.is_set():
+                if stream.current_run is not None:
+                    try:
+                        client.beta.threads.runs.cancel(run_id=stream.current_run.id, thread_id=thread_id)
+                    except Exception as e:
+                        print("Cancel error:", e)
+                return
+            if event.event == "thread.message.delta":
+                for part in event.data.delta.content or []:
+                    if part.type == "text" and part.text and part.text.value:
+                        yield part.text.value
+            elif event.event in (
+                "thread.run.failed",
+                "thread.run.expired",
+                "thread.run.cancelled",
+                "thread.run.incomplete",
+            ):
+                # Same outcome as batch mode: a run that didn't complete is an error
+                run = event.data
+                raise RuntimeError(run.last_error.message if run.last_error else f"run {run.status}")
+
+
+def _polled_text(client, thread_id: str, assistant_id: str, abort: threading.Event):
+    """Yield the final assistant message of a non-streamed run.
+
+    Polls ``runs.retrieve`` with exponential backoff rather than holding an SSE
+    stream open for the whole run; ``abort`` is checked between polls.
+    """
+    run = client.beta.threads.runs.create(
+        thread_id=thread_id,
+        assistant_id=assistant_id,
+        tool_choice={"type": "code_interpreter"},
+    )
+    delay = 0.5
+    while run.status in ("queued", "in_progress", "requires_action"):
+        if abort.wait(delay):
+            try:
+                client.beta.threads.runs.cancel(run_id=run.id, thread_id=thread_id)
+            except Exception as e:
+                print("Cancel error:", e)
+            return
+        delay = min(delay * 1.5, 5.0)
+        run = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
+    if run.status != "completed":
+        raise RuntimeError(run.last_error.message if run.last_error else f"run {run.status}")
+
+    messages = client.beta.threads.messages.list(thread_id=thread_id, run_id=run.id, limit=1)
+    for msg in messages.data:
+        for part in msg.content:
+            if part.type == "text":
+                yield part.text.value
+
+
+def _run_assistant(
+    client,
+    thread_id: str,
+    assistant_id: str,
+    live: bool,
+    tokens: queue.SimpleQueue,
+    abort: threading.Event,
+):
+    """Background worker: push the run's text onto ``tokens``, then ``None``.
+
+    Runs off the script thread, so it must not call ``st.*``; a failure is put
+    on the queue as the exception instance.
+    """
+    gen = _token_gen if live else _polled_text
+    try:
+        for token in gen(client, thread_id, assistant_id, abort):
+            tokens.put_nowait(token)
+    except Exception as e:
+        tokens.put_nowait(e)
+    finally:
+        tokens.put_nowait(None)
+
+
+# Reruns only this function on a timer, so the rest of the page stays responsive
+# while the worker thread streams
+@st.fragment(run_every=STREAM_FLUSH_INTERVAL)
+def _live_output():
+    view = st.session_state.run_view
+    done = False
+    while True:
+        try:
+            item = st.session_state.run_queue.get_nowait()
+        except queue.Empty:
+            break
+        if item is None:
+            done = True
+            break
+        if isinstance(item, Exception):
+            st.session_state.run_error = f"Analysis failed: {item}"
+        else:
+            view.feed(item)
+    view.render_live()
+    if done:
+        view.close()
+        st.session_state.run_queue = None
+        st.rerun()
+    elif view.seal():
+        # Full rerun so the main script draws the sealed page outside the fragment
+        st.rerun()
 
-# Container for streaming output
-output_container = st.empty()
 
 # -----------------------------------------------------------------------------
 # 🏃‍♂️  MAIN EXECUTION FLOW
 # -----------------------------------------------------------------------------
 if run_btn and zip_file is not None:
+    client = _get_client()
+    assistant = _get_or_create_assistant()
 
     # -------------------------
-    # 1️⃣  Upload zip to OpenAI
+    # 1️⃣  Upload zip to OpenAI & create thread
     # -------------------------
+    data = zip_file.getvalue()
+    sha = hashlib.sha256(data).hexdigest()
+    # A new zip gets a fresh thread; the same zip keeps its thread, which
+    # already has the file attached
+    new_thread = st.session_state.thread_id is None or st.session_state.zip_sha != sha
+    prev_file_id = st.session_state.file_id
+    prev_thread_id = st.session_state.thread_id
     with st.spinner("Uploading repository to OpenAI …"):
-        oai_file = client.files.create(file=zip_file, purpose="assistants")
-        st.session_state.file_id = oai_file.id
+        # Creating the thread doesn't depend on the upload, so overlap them
+        with ThreadPoolExecutor(max_workers=2) as ex:
+            f_upload = ex.submit(_upload_zip, st.session_state.upload_key, sha, zip_file.name, data)
+            f_thread = ex.submit(client.beta.threads.create) if new_thread else None
+            try:
+                st.session_state.file_id = f_upload.result()
+            except Exception:
+                # Don't leave the thread created alongside a failed upload behind
+                if f_thread is not None:
+                    try:
+                        client.beta.threads.delete(f_thread.result().id)
+                    except Exception as e:
+                        print("Cleanup error:", e)
+                raise
+            thread_id = f_thread.result().id if f_thread else st.session_state.thread_id
 
     # -------------------------
-    # 2️⃣  Create / attach thread
+    # 2️⃣  Attach file to thread (Code Interpreter needs this)
     # -------------------------
-    if st.session_state.thread_id is None:
-        thread = client.beta.threads.create()
-        st.session_state.thread_id = thread.id
-    else:
-        thread = client.beta.threads.retrieve(st.session_state.thread_id)
-
-    # Attach file to thread (Code Interpreter needs this)
-    client.beta.threads.update(
-        thread_id=thread.id,
-        tool_resources={"code_interpreter": {"file_ids": [st.session_state.file_id]}},
-    )
+    # Also re-attach when the upload cache expired and the same zip got a new id
+    if new_thread or st.session_state.file_id != prev_file_id:
+        st.session_state.thread_id = thread_id
+        st.session_state.zip_sha = sha
+        client.beta.threads.update(
+            thread_id=thread_id,
+            tool_resources={"code_interpreter": {"file_ids": [st.session_state.file_id]}},
+        )
+
+    # A superseded thread is deleted right away. A superseded upload may still
+    # be handed out by the upload cache if that zip comes back, so it (and the
+    # previous report) is only deleted on Reset, when the cache key changes.
+    if new_thread and prev_thread_id is not None:
+        try:
+            client.beta.threads.delete(prev_thread_id)
+        except Exception as e:
+            print("Cleanup error:", e)
+    for old_id in (prev_file_id, st.session_state.md_file_id):
+        if old_id and old_id != st.session_state.file_id and old_id not in st.session_state.stale_file_ids:
+            st.session_state.stale_file_ids += (old_id,)
+    st.session_state.md_file_id = None
 
     # -------------------------
     # 3️⃣  Post user message
     # -------------------------
     client.beta.threads.messages.create(
-        thread_id=thread.id,
+        thread_id=thread_id,
         role="user",
         content=user_prompt,
     )
 
     # -------------------------
-    # 4️⃣  Stream assistant run
+    # 4️⃣  Run assistant (in the background)
     # -------------------------
+    st.session_state.run_queue = queue.SimpleQueue()
+    st.session_state.run_abort = threading.Event()
+    st.session_state.run_view = _StreamView()
+    st.session_state.run_error = None
+    st.session_state.run_finished = False
+    threading.Thread(
+        target=_run_assistant,
+        args=(client, thread_id, assistant.id, live, st.session_state.run_queue, st.session_state.run_abort),
+        daemon=True,
+    ).start()
 
-    class StreamHandler(AssistantEventHandler):
-        def __init__(self, box):
-            super().__init__()
-            self.box = box
-            self.buffer = ""
+if st.session_state.run_queue is not None:
+    st.info("ThreatLens‑AI is analysing … this can take a few minutes")
+    if st.button("⏹ Stop"):
+        st.session_state.run_abort.set()
+    st.session_state.run_view.render_sealed()
+    _live_output()
 
-        @override
-        def on_text_delta(self, delta, snapshot):
-            self.buffer += delta.value or ""
-            self.box.markdown(self.buffer)
+elif st.session_state.run_view is not None:
+    st.session_state.run_view.render()
 
-    with st.spinner("ThreatLens‑AI is analysing … this can take a few minutes"):
-        with client.beta.threads.runs.stream(
-            thread_id=thread.id,
-            assistant_id=assistant.id,
-            event_handler=StreamHandler(output_container),
-            tool_choice={"type": "code_interpreter"},
-        ) as stream:
-            stream.until_done()
+    if st.session_state.run_error:
+        st.error(st.session_state.run_error)
+    elif st.session_state.run_abort.is_set():
+        st.warning("Analysis stopped.")
+    elif not st.session_state.run_finished:
+        st.success("Analysis complete! Preparing report …")
 
-    st.success("Analysis complete! Preparing report …")
+        # -------------------------
+        # 5️⃣  Locate generated report file
+        # -------------------------
+        client = _get_client()
+        thread_id = st.session_state.thread_id
 
-    # -------------------------
-    # 5️⃣  Locate generated report file
-    # -------------------------
+        def _extract_md_file_id() -> str | None:
+            messages = client.beta.threads.messages.list(thread_id=thread_id)
+            # Messages come newest first. Code Interpreter links the files it writes
+            # as file_path annotations whose text is the sandbox path, so the
+            # filename is known without a files.retrieve round-trip.
+            for msg in messages.data:
+                for part in msg.content:
+                    if part.type != "text":
+                        continue
+                    for ann in part.text.annotations:
+                        if ann.type == "file_path" and ann.text.endswith(".md"):
+                            return ann.file_path.file_id
+            # No annotation: look the attachments up, overlapping the requests
+            att_ids = [
+                att.file_id
+                for msg in messages.data
+                for att in (msg.attachments or [])
+                if att.file_id
+            ]
+            if att_ids:
+                with ThreadPoolExecutor(max_workers=8) as ex:
+                    for file_obj in ex.map(client.files.retrieve, att_ids):
+                        if file_obj.filename.endswith(".md"):
+                            return file_obj.id
+            # Fallback regex (in case attachments missing)
+            match = _FILE_ID_RE.search("\n".join(str(msg) for msg in messages.data))
+            return match.group(0) if match else None
 
-    def _extract_md_file_id() -> str | None:
-        messages = client.beta.threads.messages.list(thread_id=thread.id)
-        for msg in messages.data:
-            if hasattr(msg, "attachments") and msg.attachments:
-                for att in msg.attachments:
-                    if att.file_id:
-                        file_obj = client.files.retrieve(att.file_id)
-                        if hasattr(file_obj, "filename") and file_obj.filename.endswith(".md"):
-                            return att.file_id
-        # Fallback regex (in case attachments missing)
-        pattern = re.compile(r"file-(?:[a-zA-Z0-9]+)")
-        for msg in messages.data:
-            match = pattern.search(str(msg))
-            if match:
-                return match.group(0)
-        return None
-
-    md_file_id = _extract_md_file_id()
-
-    if md_file_id is None:
-        st.error("Could not find the generated Markdown report in the assistant messages.")
-        st.stop()
-
-    file_content = client.files.content(md_file_id).read()
-    st.session_state.report_bytes = file_content
-    st.session_state.report_name = "Medical-Diagnosis-Project-Report.md"
-    st.session_state.run_finished = True
+        md_file_id = _extract_md_file_id()
+        st.session_state.md_file_id = md_file_id
+
+        if md_file_id is None:
+            # Remembered as the run's error so reruns don't repeat the lookup
+            st.session_state.run_error = "Could not find the generated Markdown report in the assistant messages."
+            st.error(st.session_state.run_error)
+            st.stop()
+
+        # Stream the report into a single buffer rather than read()-ing it whole
+        report_buf = io.BytesIO()
+        with client.files.with_streaming_response.content(md_file_id) as resp:
+            for chunk in resp.iter_bytes(8192):
+                report_buf.write(chunk)
+        st.session_state.report_buf = report_buf
+        st.session_state.report_name = "Medical-Diagnosis-Project-Report.md"
+        st.session_state.run_finished = True
 
 # -----------------------------------------------------------------------------
 # 📄  PREVIEW & DOWNLOAD
 # -----------------------------------------------------------------------------
 if st.session_state.run_finished:
     st.header("📄 Report Preview")
-    with st.expander("Click to view full Markdown report", expanded=False):
-        st.markdown(st.session_state.report_bytes.decode("utf-8"))
+    # Expander bodies run on every rerun, so only decode the report on request
+    if st.checkbox("Show full Markdown report", key="show_preview"):
+        st.markdown(str(st.session_state.report_buf.getbuffer(), "utf-8"))
 
     st.download_button(
         label="💾 Download Report",
-        data=st.session_state.report_bytes,
+        data=st.session_state.report_buf,
         file_name=st.session_state.report_name,
         mime="text/markdown",
     )
 
     # Cleanup button (optional)
     if st.button("🧹 Reset Session"):
-        # Delete uploaded & generated files + thread to save quota
-        try:
+        # Delete uploaded & generated files + thread to save quota; the calls are
+        # independent, so issue them together and wait once
+        client = _get_client()
+        with ThreadPoolExecutor(max_workers=4) as ex:
+            futs = []
             if st.session_state.file_id:
-                client.files.delete(st.session_state.file_id)
-            if md_file_id:
-                client.files.delete(md_file_id)
+                futs.append(ex.submit(client.files.delete, st.session_state.file_id))
+            if st.session_state.md_file_id:
+                futs.append(ex.submit(client.files.delete, st.session_state.md_file_id))
             if st.session_state.thread_id:
-                client.beta.threads.delete(st.session_state.thread_id)
-        except Exception as e:
-            print("Cleanup error:", e)
-        for k in st.session_state.keys():
-            del st.session_state[k]
-        st.experimental_rerun()
+                futs.append(ex.submit(client.beta.threads.delete, st.session_state.thread_id))
+            for old_id in st.session_state.stale_file_ids:
+                futs.append(ex.submit(client.files.delete, old_id))
+            for f in futs:
+                try:
+                    f.result()
+                except Exception as e:
+                    print("Cleanup error:", e)
+        st.session_state.clear()
+        st.rerun()